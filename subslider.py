@@ -17,13 +17,16 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>
-from datetime import datetime
+from functools import lru_cache
 import argparse
+import codecs
 import collections
+import io
 import shutil
 import os
 import re
 import sys
+import tempfile
 import chardet
 
 
@@ -42,11 +45,20 @@ class SubSlider:
     passed."""
 
     LINES_TO_SHOW = 10
-    SUB_TIME_FORMAT = "(\d{2}:\d{2}:\d{2},\d{3}) \-\-> "\
-        "(\d{2}:\d{2}:\d{2},\d{3})"
+    # subs are parsed as bytes, see file_read()
+    SUB_TIME_FORMAT = rb'(\d{2}:\d{2}:\d{2},\d{3}) --> '\
+        rb'(\d{2}:\d{2}:\d{2},\d{3})'
+    # patterns are compiled once here as they're matched against every block;
+    # this one matches a whole timestamp line, including its line terminator
+    _SUB_TIME_LINE_RE = re.compile(rb'^' + SUB_TIME_FORMAT + rb'.*\n?',
+                                   re.MULTILINE)
+    _BLOCK_NUM_RE = re.compile(rb'\d+$')
+    # size of the buffer used when writing the output subs
+    WRITE_BUFFER_SIZE = 1024 * 1024
+    # how many bytes of blocks parse_subs() collects before writing them
+    WRITE_BATCH_SIZE = 64 * 1024
     DEFAULT_START_AT = "same as input; original .srt file will be copied to "\
         "ORIGINAL_SRT_NAME_orig.srt"
-    DATE_ZERO = datetime.strptime('2000/1/1', '%Y/%m/%d')
 
     def __init__(self):
         self.parser = MyParser(
@@ -100,15 +112,11 @@ class SubSlider:
             print('')
             self.parser.error('Bad arguments.')
 
-        (self.input_subs, self.output_subs, self.output_temp,
+        (self.input_subs, self.output_subs,
          minutes, seconds, millis) = parsed
 
-        if self.input_subs == self.output_subs:
-            # if input is my_movie.srt copy to my_movie_orig.srt
-            original = '%s_orig.srt' % os.path.splitext(self.input_subs)[0]
-            shutil.copyfile(self.input_subs, original)
-
-        self.first_valid = 0
+        # the input file is read only once, and kept in memory
+        self.input_data, self.input_encoding = self.file_read(self.input_subs)
 
         # if start was specified, we need to know what's the first line that
         # the offset needs to be applied to
@@ -123,24 +131,31 @@ class SubSlider:
             else:
                 # subtitles begin sooner than they should, positive offset
                 offset = starting_at - first_starts_at
-            print('Applying {} as offset'.format(offset))
+            print('Applying {} as offset'.format(self.format_time(offset)))
         else:
-            offset = self.get_date(minutes, seconds, millis) - self.DATE_ZERO
+            offset = self.get_date(minutes, seconds, millis)
 
         if subtract_offset or args.delay_video:
-            def offset_func(start, end): return (start - offset, end - offset)
-        else:
-            def offset_func(start, end): return (start + offset, end + offset)
+            offset = -offset
 
-        self.parse_subs(offset_func)
-        self.fix_file()
+        try:
+            # also catches different paths to the same file, e.g. ./my_movie.srt
+            replace_input = os.path.samefile(self.input_subs, self.output_subs)
+        except OSError:
+            # the output file doesn't exist yet
+            replace_input = False
+
+        original = None
+        if replace_input:
+            # if input is my_movie.srt copy to my_movie_orig.srt
+            original = '%s_orig.srt' % os.path.splitext(self.input_subs)[0]
+            self.file_backup(self.input_subs, original)
 
-        # clean up the temp file
-        os.remove(self.output_temp)
+        self.parse_subs(offset)
         print('Success! Offset subs have been written to {}'
               .format(os.path.abspath(self.output_subs)))
 
-        if self.input_subs == self.output_subs:
+        if original:
             print('The original subs have been copied to {}'.format(original))
 
     def check_args(self, args):
@@ -164,36 +179,23 @@ class SubSlider:
                 output_subs = input_file
             else:
                 output_subs = args.output
-            output_temp = '{}_temp.srt'.format(os.path.splitext(input_file)[0])
 
-        offset_ok = re.match('(\d{1,2}:)?\d+(,\d{1,3})?$', input_offset)
+        offset = self.parse_offset(input_offset)
 
-        if not offset_ok:
+        if not offset:
             print('{} is not a valid offset, format is [MM:]SS[,sss], see help'
                   'dialog for some examples'.format(input_offset))
             error = True
         else:
-            offset = re.search('((\d{1,2}):)?(\d+)(,(\d{1,3}))?', input_offset)
-
-            def nsafe(x): return offset.group(x) if offset.group(x) else "0"
-
-            # the ljust call is because we want e.g. '2.5' to be interpreted as
-            # 2 seconds, 500 millis
-            minutes, seconds, millis = (nsafe(2), nsafe(3),
-                                        nsafe(5).ljust(3, '0'))
-            if re.match('^\d+(,(\d{1,3}))?$', input_offset):
-                # format is seconds(,millis), convert to minutes
-                secs = int(seconds)
-                minutes = str(secs // 60)
-                seconds = str(secs % 60)
+            minutes, seconds, millis = offset
 
         if error:
             return None
 
         return_me = collections.namedtuple('Params',
-                                           ['input', 'output', 'output_tmp',
+                                           ['input', 'output',
                                             'mins', 'secs', 'millis'])
-        return return_me(input_file, output_subs, output_temp,
+        return return_me(input_file, output_subs,
                          minutes, seconds, millis)
 
     def get_offset_from_start_at(self, start_at):
@@ -202,7 +204,7 @@ class SubSlider:
         should start at the specified time, and returns the time at which the
         chosen line was originally shown.
         """
-        lines, times = self.get_first_lines(self.LINES_TO_SHOW)
+        lines, starts = self.get_first_lines(self.LINES_TO_SHOW)
         # python3 has no "raw_input()"
         try:
             _input = raw_input
@@ -235,146 +237,252 @@ class SubSlider:
                       'entered. Exiting'.format(len(choices), choice))
                 sys.exit(1)
 
-        # parse the string to get the start value
-        parsed = re.search(self.SUB_TIME_FORMAT, times[choice])
-
-        # group(1) is start, group(2) is end
-        return self.parse_time(parsed.group(1))
+        return starts[choice]
 
     def get_first_lines(self, line_count):
         """
         Parses the input subs file and returns the first 10 entries, together
-        with the time at which they're shown.
+        with the time (in milliseconds) at which they're shown.
         """
-        found = 0
+        data_encoding = (self.input_encoding
+                         if self.is_ascii_compatible(self.input_encoding)
+                         else 'utf-8')
         lines = []
-        times = []
-        buf = []
-        with SubSlider().file_open(self.input_subs, 'rt') as _input:
-            for line in _input:
-                parsed = re.search(self.SUB_TIME_FORMAT, line)
-                if parsed:
-                    if found:
-                        # don't append the UTF header
-                        lines.append('\n'.join(buf[:-1]))
-                    found += 1
-                    times.append(line)
-                    buf = []
-                else:
-                    buf.append(line.strip())
-                if found > line_count:
-                    return lines, times
-        return lines, times
-    
-    def parse_subs(self, offset_func):
+        starts = []
+        body_start = 0
+        # stop as soon as enough entries are found, without splitting the
+        # whole file into lines
+        for parsed in self._SUB_TIME_LINE_RE.finditer(self.input_data):
+            if starts:
+                # don't append the UTF header (found before the first
+                # timestamp), nor the number of the next block
+                buf = [line.strip() for line in
+                       self.input_data[body_start:parsed.start()].splitlines()]
+                lines.append(b'\n'.join(buf[:-1])
+                             .decode(data_encoding, 'replace'))
+            body_start = parsed.end()
+            # group(1) is start, group(2) is end
+            starts.append(self.parse_time(parsed.group(1)))
+            if len(starts) > line_count:
+                break
+        return lines, starts
+
+    def parse_subs(self, offset):
         """
-        Parses the original subs file and applies the offset using the argument
-        function, writing the output to a temp file.
+        Parses the original subs file and adds the argument offset (in
+        milliseconds, negative to make subs appear sooner) to all timestamps,
+        writing the output to the output subs file.
 
-        The method sets self.first_valid to the first block in the temp file
+        The method sets self.first_valid to the first block in the input file
         that has a timestamp greater than zero; this is done in case some lines
-        in the output subs ended up being displayed at negative time.
+        in the output subs ended up being displayed at negative time. Blocks
+        before that one are dropped, and the remaining ones are renumbered so
+        that they start at 1.
         """
-        with SubSlider().file_open(self.input_subs, 'r') as _input:
-            with SubSlider().file_open(self.output_temp, 'w') as output:
-                block = 0
-                for line in _input:
-                    parsed = re.search(self.SUB_TIME_FORMAT, line)
-                    if parsed:
-                        block += 1
-                        start, end = (self.parse_time(parsed.group(1)),
-                                      self.parse_time(parsed.group(2)))
-                        (start, end) = offset_func(start, end)
-                        offset_start, offset_end = (self.format_time(start),
-                                                    self.format_time(end))
-                        if not self.first_valid:
-                            if end >= self.DATE_ZERO:
-                                # this line will start at 0, and is going to be
-                                # displayed until end
-                                self.first_valid = block
-                                if start < self.DATE_ZERO:
-                                    offset_start = '00:00:00,000'
-                        output.write('{} --> {}\n'.format(offset_start,
-                                                          offset_end))
-                    else:
-                        output.write(line)
-
-    def fix_file(self):
+        # the whole file is parsed before writing anything, so input and output
+        # can be the same; bodies[i] holds the lines following times[i]
+        times = []
+        bodies = []
+        data = self.input_data
+        body_start = 0
+        first_valid = 0
+        for parsed in self._SUB_TIME_LINE_RE.finditer(data):
+            if times:
+                body = data[body_start:parsed.start()]
+                # block numbers are rewritten when writing the output
+                last_line = body.rfind(b'\n', 0, len(body) - 1) + 1
+                if self._BLOCK_NUM_RE.match(body[last_line:].strip()):
+                    body = body[:last_line]
+                bodies.append(body)
+            body_start = parsed.end()
+            # times are in milliseconds, see parse_time()
+            start, end = (self.parse_time(parsed.group(1)) + offset,
+                          self.parse_time(parsed.group(2)) + offset)
+            if not first_valid:
+                if end < 0:
+                    # this block is dropped, no need to format its times
+                    times.append(None)
+                    continue
+                first_valid = len(times) + 1
+            if start < 0:
+                # this line (the first valid one, or one that overlaps it)
+                # will start at 0, and is going to be displayed until end
+                start = 0
+            times.append('{} --> {}\n'.format(self.format_time(start),
+                                               self.format_time(end))
+                         .encode('ascii'))
+        if times:
+            bodies.append(data[body_start:])
+        self.first_valid = first_valid
+
+        # the output is written to a temp file in the same directory, which
+        # then atomically replaces the output file (or the input file, leaving
+        # a hard linked backup untouched); if the output is a symlink, the file
+        # it points to is replaced rather than the link itself
+        output_path = os.path.realpath(self.output_subs)
+        temp_fd, output_temp = tempfile.mkstemp(
+            dir=os.path.dirname(output_path), suffix='.srt')
+        try:
+            with os.fdopen(temp_fd, 'wb', self.WRITE_BUFFER_SIZE) as temp:
+                if self.is_ascii_compatible(self.input_encoding):
+                    output = temp
+                else:
+                    # the input was converted to UTF-8 by file_read(), the
+                    # output is converted back to its encoding once complete
+                    output = io.BytesIO()
+                if data.startswith(codecs.BOM_UTF8):
+                    # keep the BOM, as it's dropped together with the first
+                    # block
+                    output.write(codecs.BOM_UTF8)
+                # we can drop all blocks found before the first valid one (if
+                # there's none, all lines would be displayed at negative
+                # time), and renumber blocks so that they start at 1, no
+                # matter what
+                first = (self.first_valid - 1 if self.first_valid
+                         else len(times))
+                # blocks are written in batches to save on write() calls
+                buf = []
+                buf_size = 0
+                for block_num, (time, body) in enumerate(
+                        zip(times[first:], bodies[first:]), 1):
+                    buf.append('{}\r\n'.format(block_num).encode('ascii'))
+                    buf.append(time)
+                    buf.append(body)
+                    buf_size += len(time) + len(body)
+                    if buf_size > self.WRITE_BATCH_SIZE:
+                        output.writelines(buf)
+                        buf = []
+                        buf_size = 0
+                output.writelines(buf)
+                if output is not temp:
+                    temp.write(output.getvalue().decode('utf-8')
+                               .encode(self.input_encoding))
+
+            if os.path.isfile(output_path):
+                # keep the permissions of the file being replaced
+                shutil.copymode(output_path, output_temp)
+            else:
+                # mkstemp() creates files only readable by their owner
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(output_temp, 0o666 & ~umask)
+            os.replace(output_temp, output_path)
+        except BaseException:
+            os.remove(output_temp)
+            raise
+
+    @staticmethod
+    def format_time(value):
         """
-        Parses the temp file created by parse_subs and renumbers blocks in case
-        lines were dropped because the offset pushed them to negative
-        timestamps.
+        Formats a time expressed in milliseconds using the format
+        'HH:MM:SS,mmm'.
         """
-        with SubSlider().file_open(self.output_temp, 'r') as _input:
-            with SubSlider().file_open(self.output_subs, 'w') as output:
-                # we can drop all lines found before the first valid block
-                # (set by parse_subs())
-                start_output = False
-                for line in _input:
-                    if re.match('\d+$', line.strip()):
-                        block_num = int(line.strip())
-                        if block_num >= self.first_valid:
-                            # ok, start parsing
-                            if not start_output:
-                                start_output = True
-                            # and renumber blocks so that they start at 1, no
-                            # matter what
-                            output.write(
-                                '{}\r\n'
-                                .format(block_num - self.first_valid + 1)
-                            )
-                    elif start_output:
-                        output.write(line)
-    
+        seconds, millis = divmod(value, 1000)
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        return '{:02d}:{:02d}:{:02d},{:03d}'.format(hours, minutes, seconds,
+                                                    millis)
+
     @staticmethod
-    def format_time(value):
+    def parse_offset(offset):
         """
-        Parses a date using the format '%H:%M:%S,%f'.
+        Parses an offset using the format [mm:]SS[,sss] and returns its
+        (minutes, seconds, millis) as strings, or None if the format is wrong.
         """
-        formatted = datetime.strftime(value, '%H:%M:%S,%f')
-        return formatted[:-3]
+        def is_number(s, max_len=None):
+            return (s and not s.strip('0123456789') and
+                    (max_len is None or len(s) <= max_len))
+
+        minutes, has_minutes, rest = offset.rpartition(':')
+        seconds, has_millis, millis = rest.partition(',')
+        if ((has_minutes and not is_number(minutes, 2)) or
+                not is_number(seconds) or
+                (has_millis and not is_number(millis, 3))):
+            return None
+
+        # the ljust call is because we want e.g. '2,5' to be interpreted as
+        # 2 seconds, 500 millis
+        millis = millis.ljust(3, '0')
+        if not has_minutes:
+            # format is seconds(,millis), convert to minutes
+            secs = int(seconds)
+            minutes = str(secs // 60)
+            seconds = str(secs % 60)
+        return minutes, seconds, millis
 
     @staticmethod
     def get_date(minutes, seconds, millis):
         """
-        Returns a date that can be used for comparisons with timestamps in the
-        .srt file.
+        Returns a time in milliseconds that can be used for comparisons with
+        timestamps in the .srt file.
         """
         def nsafe(s): return int(s) if s else 0
-        return datetime(2000, 1, 1, 0, nsafe(minutes), nsafe(seconds),
-                        nsafe(millis) * 1000)
+        return ((nsafe(minutes) * 60 + nsafe(seconds)) * 1000 +
+                nsafe(millis))
 
     @staticmethod
+    @lru_cache(maxsize=1 << 17)
     def parse_time(time):
         """
-        Parses a date using the format '%H:%M:%S,%f' and sets the year to 2000
-        to avoid trouble.
+        Parses a time using the format 'HH:MM:SS,mmm' and returns it in
+        milliseconds.
+
+        Timestamps in .srt files always have this format, so fields are sliced
+        at fixed positions rather than going through strptime(). Results are
+        cached, as the same timestamps often appear more than once.
         """
-        parsed = datetime.strptime(time, '%H:%M:%S,%f')
-        return parsed.replace(year=2000)
+        return (((int(time[0:2]) * 60 + int(time[3:5])) * 60 +
+                 int(time[6:8])) * 1000 + int(time[9:12]))
     
     @staticmethod
-    def get_python_version():
+    def file_backup(src_path, dst_path):
         """
-        Returns the major version of the python executing the code
+        Create dst_path as a hard link to src_path if possible, or as a copy
+        of it otherwise
         """
-        return sys.version_info[0]
+        try:
+            # link the file itself, not a symlink pointing to it, so that the
+            # backup still holds the original data once the file is replaced
+            os.link(os.path.realpath(src_path), dst_path)
+        except (AttributeError, OSError):
+            # no os.link() on this platform, the target already exists, or it's
+            # on a file system that doesn't support hard links
+            if os.path.isfile(dst_path) and os.path.samefile(src_path,
+                                                             dst_path):
+                # the target is already a link to the source (e.g. a previous
+                # run was interrupted), copying would truncate both
+                return
+            shutil.copyfile(src_path, dst_path)
 
     @staticmethod
-    def file_open(file_path, file_mode):
+    def file_read(file_path):
         """
-        Find a file's encoding, open it in a specific mode, and return that object
-        """
-        python_major_version = SubSlider().get_python_version()
-        file_encoding = None
-        if python_major_version == 3:
-            file_encoding = "utf-8"  # Default encoding in Python 3
+        Read a whole subs file at once, and return its content as bytes with
+        newlines translated as if it was opened in text mode, together with
+        its encoding.
 
-        if os.path.isfile(file_path):  # If file already exists
-            raw_file_data = open(file_path, 'rb').read()
-            file_encoding = chardet.detect(raw_file_data)['encoding']  # Check encoding of existing file
+        Subs are parsed as bytes, so files using an encoding that is not a
+        superset of ASCII (e.g. UTF-16) are converted to UTF-8; the returned
+        encoding is still the original one
+        """
+        with open(file_path, 'rb') as _input:
+            data = _input.read()
+        file_encoding = chardet.detect(data)['encoding'] or 'utf-8'
+        if not SubSlider().is_ascii_compatible(file_encoding):
+            data = data.decode(file_encoding).encode('utf-8')
+        return data.replace(b'\r\n', b'\n').replace(b'\r', b'\n'), file_encoding
 
-        return open(file = file_path, mode = file_mode, encoding = file_encoding)
+    @staticmethod
+    def is_ascii_compatible(encoding):
+        """
+        Check whether ASCII text (timestamps, block numbers and newlines) is
+        encoded the same way in the argument encoding as it is in ASCII
+        """
+        ascii_data = b'0123456789:, -->\n'
+        try:
+            return ascii_data.decode(encoding) == ascii_data.decode('ascii')
+        except UnicodeDecodeError:
+            return False
 
 
 if __name__ == '__main__':